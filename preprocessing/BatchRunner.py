@@ -0,0 +1,251 @@
+import os
+import time
+import uuid
+import multiprocessing as mp
+import pandas as ps
+from ImgFeatures import ImgFeatures
+from RunManifest import RunManifest
+from ImgPrefetcher import ImgPrefetcher
+from ResultSink import ResultSink
+from StageProfiler import StageProfiler
+
+# ImgFeatures object and image prefetch settings owned by each worker process.  Set once per process by initWorker
+workerFeatures = None
+workerPrefetch = (0,1)
+# optional threading.Event that stops the shard being processed by a worker, see DistributedRunner.runQueueWorker
+workerStopEvent = None
+
+# create the ImgFeatures object used by a worker process
+# INPUTS:
+#    imgFolder (str) - absolute filepath to folder containing .jpg images
+#    npyFolder (str) - absolute filepath to folder containing PSPNet .npy predictions
+#    queueDepth (int) - number of images each worker loads ahead of processing.  0 to load serially
+#    numThreads (int) - number of reader threads per worker
+#    labelStoreFolder (str) - optional.  Absolute filepath to a packed label store
+#    featureCacheFilepath (str) - optional.  Absolute filepath to a label and pair count cache, shared by all workers
+#    profile (boolean) - whether or not to record per-stage timing and counters, see StageProfiler
+#    logInterval (float) - optional.  Seconds between json metric lines printed by each worker
+#    categoryFilepath (str) - optional.  Absolute filepath to a json file of custom composite categories, see
+#                             ImgFeatures.loadCategoryDicts
+def initWorker(imgFolder,npyFolder,queueDepth=0,numThreads=1,labelStoreFolder=None,featureCacheFilepath=None,
+               profile=False,logInterval=None,categoryFilepath=None):
+    global workerFeatures, workerPrefetch
+    profiler = StageProfiler(enabled=profile,logInterval=logInterval)
+    workerFeatures = ImgFeatures(imgFolder,npyFolder,labelStoreFolder,featureCacheFilepath,profiler,categoryFilepath)
+    workerPrefetch = (queueDepth,numThreads)
+
+# write a dataframe to csv.  Output is first written to a temporary file and then renamed, so
+# partially written shards are never mistaken for completed ones
+# INPUTS:
+#    dataframe (pandas dataframe) - data to write
+#    outFilepath (str) - absolute filepath of the output csv file
+def writeShardCsv(dataframe,outFilepath):
+    tempFilepath = outFilepath + ".tmp"
+    dataframe.to_csv(tempFilepath,index=False)
+    os.replace(tempFilepath,outFilepath)
+
+# write the list of images that could not be processed within a shard.  Error lists are stored in an
+# "errors" subfolder so the output folder only contains shard results (see ImgFeatures.loadSpatialFiles)
+# INPUTS:
+#    errors (list) - (filename, error message) tuples
+#    outFilepath (str) - absolute filepath of the shard output file
+def writeShardErrors(errors,outFilepath):
+    outFolder, outFilename = os.path.split(outFilepath)
+    errorDF = ps.DataFrame(errors,columns=['filename','error'])
+    writeShardCsv(errorDF,outFolder + "/errors/" + os.path.splitext(outFilename)[0] + "_errors.csv")
+
+# get the metrics recorded by the worker's profiler
+# OUTPUTS:
+#    (dictionary) - see StageProfiler.getMetrics.  None if profiling is disabled
+def getWorkerMetrics():
+    if not workerFeatures.profiler.enabled:
+        return(None)
+    return(workerFeatures.profiler.getMetrics())
+
+# calculate joint count statistics for one shard of .npy files
+# INPUTS:
+#    shard (tuple) - output filepath and list of .npy files to process
+# OUTPUTS:
+#    (tuple) - output filepath, files in the shard, (filename, error message) tuples for failed images, 
+#              seconds spent waiting on image loading, and profiler metrics (None if profiling is disabled)
+def processSpatialShard(shard):
+    outFilepath, files = shard
+    errors = []
+    workerFeatures.profiler.reset()
+    prefetcher = ImgPrefetcher(*workerPrefetch,stopEvent=workerStopEvent)
+    if outFilepath.endswith('.csv'):
+        results = workerFeatures.processAllImagesSpatial(workerFeatures.npyFolder,files,errors=errors,prefetcher=prefetcher)
+        writeShardCsv(results,outFilepath)
+    else:
+        sink = ResultSink(outFilepath,workerFeatures.header)
+        workerFeatures.processAllImagesSpatial(workerFeatures.npyFolder,files,errors=errors,prefetcher=prefetcher,sink=sink)
+        sink.close()
+    writeShardErrors(errors,outFilepath)
+    return((outFilepath,files,errors,prefetcher.stallTime,getWorkerMetrics()))
+
+# calculate green screen statistics for one shard of .jpg files
+# INPUTS:
+#    shard (tuple) - output filepath and list of .jpg files to process
+# OUTPUTS:
+#    (tuple) - output filepath, files in the shard, (filename, error message) tuples for failed images, 
+#              seconds spent waiting on image loading, and profiler metrics (None if profiling is disabled)
+def processGreenShard(shard):
+    outFilepath, files = shard
+    errors = []
+    workerFeatures.profiler.reset()
+    prefetcher = ImgPrefetcher(*workerPrefetch,stopEvent=workerStopEvent)
+    if outFilepath.endswith('.csv'):
+        results = workerFeatures.processAllImagesGreen(imgFiles=files,errors=errors,prefetcher=prefetcher)
+        writeShardCsv(results,outFilepath)
+    else:
+        sink = ResultSink(outFilepath,workerFeatures.createGreenspaceHeader() + ['filename'])
+        workerFeatures.processAllImagesGreen(imgFiles=files,errors=errors,prefetcher=prefetcher,sink=sink)
+        sink.close()
+    writeShardErrors(errors,outFilepath)
+    return((outFilepath,files,errors,prefetcher.stallTime,getWorkerMetrics()))
+
+# split image processing across a pool of worker processes.  Images are partitioned into fixed size
+# shards; each shard is processed independently by one worker and written to its own output file, along
+# with a csv listing the images in the shard that could not be processed.  Without a run manifest, shards
+# whose output already exists are skipped, so an interrupted run can be restarted with the same file list.
+# With a run manifest, the status of each image is recorded as shards complete, and only images that
+# are not yet recorded are processed
+class BatchRunner:
+
+    # INPUTS:
+    #    imgFolder (str) - absolute filepath to folder containing .jpg images
+    #    npyFolder (str) - absolute filepath to folder containing PSPNet .npy predictions
+    #    outFolder (str) - absolute filepath to folder where shard output files are written
+    #    shardSize (int) - number of images per output shard.  Should be small enough that each
+    #                      worker receives several shards, to keep all cores busy until the end of a run
+    #    numWorkers (int) - number of worker processes.  Defaults to the number of cores
+    #    manifestFilepath (str) - optional.  Absolute filepath of the sqlite run manifest
+    #    queueDepth (int) - number of images each worker loads ahead of processing.  0 to load serially
+    #    numThreads (int) - number of image reader threads per worker
+    #    labelStoreFolder (str) - optional.  Absolute filepath to a packed label store, used instead of npyFolder
+    #    featureCacheFilepath (str) - optional.  Absolute filepath to a label and pair count cache
+    #    outputFormat (str) - format of shard output files: 'csv', or 'parquet' or 'arrow' for float32 columnar
+    #                         files written with ResultSink (requires pyarrow)
+    #    profile (boolean) - whether or not to record per-stage timing and counters in each worker.  Metrics of all
+    #                        shards are combined in self.profiler
+    #    logInterval (float) - optional.  Seconds between json metric lines printed by each worker while profiling
+    #    categoryFilepath (str) - optional.  Absolute filepath to a json file of custom composite categories used by
+    #                             every worker, see ImgFeatures.loadCategoryDicts
+    def __init__(self,imgFolder,npyFolder,outFolder,shardSize=10000,numWorkers=None,manifestFilepath=None,
+                 queueDepth=0,numThreads=1,labelStoreFolder=None,featureCacheFilepath=None,outputFormat='csv',
+                 profile=False,logInterval=None,categoryFilepath=None):
+        self.imgFolder = imgFolder
+        self.npyFolder = npyFolder
+        self.outFolder = outFolder
+        self.shardSize = shardSize
+        self.numWorkers = numWorkers if numWorkers is not None else mp.cpu_count()
+        self.queueDepth = queueDepth
+        self.numThreads = numThreads
+        self.labelStoreFolder = labelStoreFolder
+        self.featureCacheFilepath = featureCacheFilepath
+        if outputFormat not in ['csv','parquet','arrow']:
+            raise ValueError("unsupported output format %s" %(outputFormat))
+        self.outputFormat = outputFormat
+        self.profile = profile
+        self.logInterval = logInterval
+        self.categoryFilepath = categoryFilepath
+        self.profiler = StageProfiler(enabled=profile)
+        if not os.path.exists(self.outFolder + "/errors"):
+            os.makedirs(self.outFolder + "/errors")
+        self.manifest = RunManifest(manifestFilepath) if manifestFilepath is not None else None
+
+    # partition a list of files into shards, skipping shards that have already been written.  When a
+    # run manifest is used, the file list differs between restarts, so shard filenames include the
+    # start time and a unique id of the run instead
+    # INPUTS:
+    #    files (str list) - relative filepaths of images to process
+    #    prefix (str) - prefix of shard output filenames
+    #    debug (boolean) - whether or not to print skipped shards
+    # OUTPUTS:
+    #    shards (list) - tuples of shard output filepath and the files in the shard
+    def createShards(self,files,prefix,debug=False):
+        files = list(files)
+        if self.manifest is not None:
+            prefix = prefix + "_" + time.strftime("%Y%m%d%H%M%S") + "_" + uuid.uuid4().hex[:8]
+        shards = []
+        for start in range(0,len(files),self.shardSize):
+            end = start + self.shardSize
+            outFilepath = self.outFolder + "/" + prefix + "_" + str(start) + "_" + str(end) + "." + self.outputFormat
+            if os.path.exists(outFilepath):
+                if debug:
+                    print("%s already exists" %(outFilepath))
+                continue
+            shards.append((outFilepath,files[start:end]))
+        return(shards)
+
+    # process shards with the worker pool
+    # INPUTS:
+    #    shardFunction (function) - function that processes and writes a single shard
+    #    shards (list) - tuples of shard output filepath and the files in the shard
+    #    stage (str) - name of the processing stage, used for the run manifest
+    #    folder (str) - absolute filepath of folder containing the files being processed
+    #    debug (boolean) - whether or not to print progress updates
+    # OUTPUTS:
+    #    summary (list) - output filepath, number of processed images, number of failed images, and seconds
+    #                     spent waiting on image loading per shard
+    def runShards(self,shardFunction,shards,stage,folder,debug=False):
+        summary = []
+        if(len(shards)==0):
+            return(summary)
+        numWorkers = min(self.numWorkers,len(shards))
+        self.profiler.reset()
+        initArgs = (self.imgFolder,self.npyFolder,self.queueDepth,self.numThreads,self.labelStoreFolder,
+                    self.featureCacheFilepath,self.profile,self.logInterval,self.categoryFilepath)
+        with mp.Pool(numWorkers,initializer=initWorker,initargs=initArgs) as pool:
+            for outFilepath, files, errors, stallTime, metrics in pool.imap_unordered(shardFunction,shards):
+                self.profiler.merge(metrics)
+                if self.manifest is not None:
+                    self.manifest.recordShard(stage,folder,files,errors)
+                shardSummary = (outFilepath,len(files)-len(errors),len(errors),stallTime)
+                summary.append(shardSummary)
+                if debug:
+                    print("wrote %s: %i images processed, %i failed, %.1f seconds waiting on image loading" %shardSummary)
+        return(summary)
+
+    # get the files that still need to be processed for a stage.  With a run manifest, files that are already
+    # recorded are skipped.  Without one, all files in the folder are returned in sorted order, so shard
+    # filenames are the same between restarts and completed shards are skipped (see createShards)
+    # INPUTS:
+    #    stage (str) - name of the processing stage
+    #    folder (str) - absolute filepath of folder containing the files
+    #    extension (str) - only files ending with the extension are included (e.g. '.npy')
+    # OUTPUTS:
+    #    (str list) - relative filepaths of files to process
+    def getFilesToProcess(self,stage,folder,extension):
+        if self.manifest is None:
+            with os.scandir(folder) as entries:
+                return(sorted([entry.name for entry in entries if entry.name.endswith(extension) and entry.is_file()]))
+        return(self.manifest.getRemaining(stage,self.manifest.scanFolder(folder,extension)))
+
+    # calculate joint count statistics for a list of .npy files
+    # INPUTS:
+    #    filesToProcess (str list) - relative filepaths of .npy files within the npy folder.  If None, all
+    #                                .npy files not yet recorded in the run manifest (or all .npy files in the
+    #                                folder, without a manifest) are processed
+    #    debug (boolean) - whether or not to print progress updates
+    # OUTPUTS:
+    #    summary (list) - per shard summary, see runShards
+    def runSpatial(self,filesToProcess=None,debug=False):
+        if filesToProcess is None:
+            filesToProcess = self.getFilesToProcess('spatial',self.npyFolder,'.npy')
+        shards = self.createShards(filesToProcess,"spatial_clust",debug)
+        return(self.runShards(processSpatialShard,shards,'spatial',self.npyFolder,debug))
+
+    # calculate green screen statistics for a list of .jpg files
+    # INPUTS:
+    #    imgFiles (str list) - relative filepaths of .jpg files within the img folder.  If None, all .jpg
+    #                          files not yet recorded in the run manifest (or all .jpg files in the folder,
+    #                          without a manifest) are processed
+    #    debug (boolean) - whether or not to print progress updates
+    # OUTPUTS:
+    #    summary (list) - per shard summary, see runShards
+    def runGreen(self,imgFiles=None,debug=False):
+        if imgFiles is None:
+            imgFiles = self.getFilesToProcess('green',self.imgFolder,'.jpg')
+        shards = self.createShards(imgFiles,"green_screen",debug)
+        return(self.runShards(processGreenShard,shards,'green',self.imgFolder,debug))
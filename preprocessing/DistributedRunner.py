@@ -0,0 +1,318 @@
+import os
+import time
+import socket
+import argparse
+import threading
+import multiprocessing as mp
+import pandas as ps
+import BatchRunner
+from WorkQueue import WorkQueue
+from ResultSink import ResultSink, readResultFile, COLUMNAR_EXTENSIONS
+
+# shard function and merged output prefix of each processing stage
+STAGE_FUNCTIONS = {'spatial':BatchRunner.processSpatialShard,'green':BatchRunner.processGreenShard}
+STAGE_PREFIXES = {'spatial':'spatial_clust','green':'green_screen'}
+
+# renews a lease in a background thread while the lease is processed.  Uses its own queue connection, since
+# sqlite connections can't be shared between threads.  If the worker process is killed, renewals stop and the
+# lease expires.  If a renewal finds that the lease was reassigned, lostEvent is set so processing can stop early
+class LeaseHeartbeat(threading.Thread):
+
+    # INPUTS:
+    #    queueFilepath (str) - absolute filepath of the sqlite work queue
+    #    lease (tuple) - lease returned by WorkQueue.claimLease
+    #    leaseSeconds (float) - seconds until the lease expires unless it is renewed.  Leases are renewed
+    #                           three times per leaseSeconds
+    def __init__(self,queueFilepath,lease,leaseSeconds):
+        threading.Thread.__init__(self,daemon=True)
+        self.queueFilepath = queueFilepath
+        self.stage, self.leaseIndex, self.attempt = lease[:3]
+        self.leaseSeconds = leaseSeconds
+        self.stopEvent = threading.Event()
+        self.lostEvent = threading.Event()
+
+    def run(self):
+        queue = WorkQueue(self.queueFilepath)
+        try:
+            while not self.stopEvent.wait(self.leaseSeconds/3):
+                if not queue.renewLease(self.stage,self.leaseIndex,self.attempt,self.leaseSeconds):
+                    self.lostEvent.set()
+                    return
+        finally:
+            queue.close()
+
+    def stop(self):
+        self.stopEvent.set()
+        self.join()
+
+# get the filepath of the error list written by BatchRunner.writeShardErrors for a shard output file
+# INPUTS:
+#    outFilepath (str) - absolute filepath of the shard output file
+# OUTPUTS:
+#    (str) - absolute filepath of the error list
+def getErrorFilepath(outFilepath):
+    outFolder, outFilename = os.path.split(outFilepath)
+    return(outFolder + "/errors/" + os.path.splitext(outFilename)[0] + "_errors.csv")
+
+# delete the output file, partially written output file, and error list of a lease attempt
+# INPUTS:
+#    outFilepath (str) - absolute filepath of the attempt's output file
+def removeLeaseOutputs(outFilepath):
+    for filepath in [outFilepath,outFilepath + ".tmp",getErrorFilepath(outFilepath)]:
+        try:
+            os.remove(filepath)
+        except OSError:
+            pass
+
+# claim and process leases from a work queue until all stages are finished.  Each attempt writes its output
+# to its own file in the "leases" subfolder of outFolder, and the file is only recorded in the queue if the
+# attempt still holds the lease.  Attempts that lose their lease stop before their next image, and their
+# outputs are deleted
+# INPUTS:
+#    queueFilepath (str) - absolute filepath of the sqlite work queue
+#    imgFolder (str) - absolute filepath to folder containing .jpg images
+#    npyFolder (str) - absolute filepath to folder containing PSPNet .npy predictions
+#    outFolder (str) - absolute filepath to folder where outputs are written
+#    leaseSeconds (float) - seconds until a claimed lease expires unless it is renewed
+#    pollInterval (float) - seconds to wait before checking for work again when all remaining leases are held
+#                           by other workers
+#    maxAttempts (int) - number of times a lease can be claimed before it is marked as failed
+#    queueDepth (int) - number of images loaded ahead of processing.  0 to load serially
+#    numThreads (int) - number of image reader threads
+#    labelStoreFolder (str) - optional.  Absolute filepath to a packed label store
+#    featureCacheFilepath (str) - optional.  Absolute filepath to a label and pair count cache
+#    categoryFilepath (str) - optional.  Absolute filepath to a json file of custom composite categories, see
+#                             ImgFeatures.loadCategoryDicts
+#    debug (boolean) - whether or not to print progress updates
+# OUTPUTS:
+#    numCompleted (int) - number of leases completed by the worker
+def runQueueWorker(queueFilepath,imgFolder,npyFolder,outFolder,leaseSeconds=600,pollInterval=5,maxAttempts=3,
+                   queueDepth=0,numThreads=1,labelStoreFolder=None,featureCacheFilepath=None,categoryFilepath=None,
+                   debug=False):
+    BatchRunner.initWorker(imgFolder,npyFolder,queueDepth,numThreads,labelStoreFolder,featureCacheFilepath,
+                           categoryFilepath=categoryFilepath)
+    queue = WorkQueue(queueFilepath,maxAttempts)
+    workerId = socket.gethostname() + "_" + str(os.getpid())
+    leaseFolder = outFolder + "/leases"
+    os.makedirs(leaseFolder + "/errors",exist_ok=True)
+    numCompleted = 0
+    while True:
+        lease = queue.claimLease(workerId,leaseSeconds)
+        if lease is None:
+            if queue.isFinished():
+                break
+            time.sleep(pollInterval)
+            continue
+        stage, leaseIndex, attempt, files, outputFormat = lease
+        outFilepath = (leaseFolder + "/" + STAGE_PREFIXES[stage] + "_" + str(leaseIndex) + "_attempt" +
+                       str(attempt) + "." + outputFormat)
+        heartbeat = LeaseHeartbeat(queueFilepath,lease,leaseSeconds)
+        BatchRunner.workerStopEvent = heartbeat.lostEvent
+        heartbeat.start()
+        try:
+            outFilepath, files, errors, stallTime, metrics = STAGE_FUNCTIONS[stage]((outFilepath,files))
+        except Exception as e:
+            heartbeat.stop()
+            if heartbeat.lostEvent.is_set():
+                removeLeaseOutputs(outFilepath)
+                if debug:
+                    print("%s lost %s lease %i, stopped processing" %(workerId,stage,leaseIndex))
+                continue
+            queue.releaseLease(stage,leaseIndex,attempt,str(e))
+            if debug:
+                print("%s couldn't process %s lease %i: %s" %(workerId,stage,leaseIndex,str(e)))
+            continue
+        heartbeat.stop()
+        if queue.completeLease(stage,leaseIndex,attempt,outFilepath,len(errors)):
+            numCompleted += 1
+            if debug:
+                print("%s completed %s lease %i: %i images processed, %i failed"
+                      %(workerId,stage,leaseIndex,len(files)-len(errors),len(errors)))
+        else:
+            removeLeaseOutputs(outFilepath)
+            if debug:
+                print("%s lost %s lease %i, discarded output" %(workerId,stage,leaseIndex))
+    queue.close()
+    return(numCompleted)
+
+# concatenate csv files with identical headers, keeping the header of the first file only.  Files are
+# copied as text, so values are written exactly as in the shard outputs
+# INPUTS:
+#    filepaths (str list) - absolute filepaths of csv files to concatenate
+#    outFilepath (str) - absolute filepath of the output csv file
+def concatCsvFiles(filepaths,outFilepath):
+    tempFilepath = outFilepath + ".tmp"
+    with open(tempFilepath,'w') as outFile:
+        for fileIndex, filepath in enumerate(filepaths):
+            with open(filepath) as inFile:
+                header = inFile.readline()
+                if(fileIndex == 0):
+                    outFile.write(header)
+                for line in inFile:
+                    outFile.write(line)
+    os.replace(tempFilepath,outFilepath)
+
+# coordinate processing of image sets by any number of worker processes, on one or several machines, through
+# a sqlite work queue (see WorkQueue).  The coordinator partitions file lists into leases, workers claim and
+# process leases (see runQueueWorker), and the coordinator merges the lease outputs into one file per stage.
+# Each image appears exactly once in the merged results or the merged error list, even if workers were killed
+# while processing a lease
+class DistributedRunner:
+
+    # INPUTS:
+    #    imgFolder (str) - absolute filepath to folder containing .jpg images
+    #    npyFolder (str) - absolute filepath to folder containing PSPNet .npy predictions
+    #    outFolder (str) - absolute filepath to folder where lease and merged output files are written
+    #    queueFilepath (str) - absolute filepath of the sqlite work queue
+    #    leaseSize (int) - number of images per lease
+    #    leaseSeconds (float) - seconds until a claimed lease expires unless it is renewed by its worker
+    #    maxAttempts (int) - number of times a lease can be claimed before it is marked as failed
+    #    outputFormat (str) - format of output files: 'csv', or 'parquet' or 'arrow' for float32 columnar files
+    #                         written with ResultSink (requires pyarrow)
+    #    queueDepth (int) - number of images each worker loads ahead of processing.  0 to load serially
+    #    numThreads (int) - number of image reader threads per worker
+    #    labelStoreFolder (str) - optional.  Absolute filepath to a packed label store, used instead of npyFolder
+    #    featureCacheFilepath (str) - optional.  Absolute filepath to a label and pair count cache
+    #    categoryFilepath (str) - optional.  Absolute filepath to a json file of custom composite categories used by
+    #                             every worker, see ImgFeatures.loadCategoryDicts
+    def __init__(self,imgFolder,npyFolder,outFolder,queueFilepath,leaseSize=1000,leaseSeconds=600,maxAttempts=3,
+                 outputFormat='csv',queueDepth=0,numThreads=1,labelStoreFolder=None,featureCacheFilepath=None,
+                 categoryFilepath=None):
+        if outputFormat not in ['csv','parquet','arrow']:
+            raise ValueError("unsupported output format %s" %(outputFormat))
+        self.imgFolder = imgFolder
+        self.npyFolder = npyFolder
+        self.outFolder = outFolder
+        self.queueFilepath = queueFilepath
+        self.leaseSize = leaseSize
+        self.leaseSeconds = leaseSeconds
+        self.maxAttempts = maxAttempts
+        self.outputFormat = outputFormat
+        self.queueDepth = queueDepth
+        self.numThreads = numThreads
+        self.labelStoreFolder = labelStoreFolder
+        self.featureCacheFilepath = featureCacheFilepath
+        self.categoryFilepath = categoryFilepath
+        os.makedirs(self.outFolder + "/errors",exist_ok=True)
+        self.queue = WorkQueue(queueFilepath,maxAttempts)
+
+    # add leases for the joint count statistics of a list of .npy files
+    # INPUTS:
+    #    filesToProcess (str list) - relative filepaths of .npy files within the npy folder.  Defaults to all
+    #                                .npy files in the folder
+    # OUTPUTS:
+    #    (int) - number of leases in the stage
+    def submitSpatial(self,filesToProcess=None):
+        if filesToProcess is None:
+            filesToProcess = sorted([file for file in os.listdir(self.npyFolder) if file.endswith('.npy')])
+        return(self.queue.addLeases('spatial',filesToProcess,self.leaseSize,self.outputFormat))
+
+    # add leases for the green screen statistics of a list of .jpg files
+    # INPUTS:
+    #    imgFiles (str list) - relative filepaths of .jpg files within the img folder.  Defaults to all .jpg
+    #                          files in the folder
+    # OUTPUTS:
+    #    (int) - number of leases in the stage
+    def submitGreen(self,imgFiles=None):
+        if imgFiles is None:
+            imgFiles = sorted([file for file in os.listdir(self.imgFolder) if file.endswith('.jpg')])
+        return(self.queue.addLeases('green',imgFiles,self.leaseSize,self.outputFormat))
+
+    # get the arguments of runQueueWorker for workers of this run
+    def getWorkerArgs(self,debug=False):
+        return((self.queueFilepath,self.imgFolder,self.npyFolder,self.outFolder,self.leaseSeconds,
+                min(5,self.leaseSeconds/3),self.maxAttempts,self.queueDepth,self.numThreads,self.labelStoreFolder,
+                self.featureCacheFilepath,self.categoryFilepath,debug))
+
+    # process all submitted leases with worker processes on this machine.  Workers on other machines can
+    # process the same queue at the same time with runQueueWorker
+    # INPUTS:
+    #    numWorkers (int) - number of worker processes.  Defaults to the number of cores
+    #    debug (boolean) - whether or not to print progress updates
+    def runLocalWorkers(self,numWorkers=None,debug=False):
+        numWorkers = numWorkers if numWorkers is not None else mp.cpu_count()
+        workers = [mp.Process(target=runQueueWorker,args=self.getWorkerArgs(debug)) for workerIndex in range(numWorkers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    # merge the lease outputs of a finished stage into a single output file, and the lease error lists into a
+    # single error list.  Images in leases that failed on every attempt are added to the error list
+    # INPUTS:
+    #    stage (str) - name of the processing stage, 'spatial' or 'green'
+    #    debug (boolean) - whether or not to print a summary
+    # OUTPUTS:
+    #    mergedFilepath (str) - absolute filepath of the merged output file.  None if the stage has no completed leases
+    def mergeStage(self,stage,debug=False):
+        if not self.queue.isFinished(stage):
+            raise ValueError("%s stage has unfinished leases: %s" %(stage,str(self.queue.getStatusCounts(stage))))
+        leaseFilepaths = []
+        errorDFs = []
+        for leaseIndex, status, files, outFilepath, error in self.queue.getFinishedLeases(stage):
+            if(status == 'done'):
+                leaseFilepaths.append(outFilepath)
+                errorDFs.append(ps.read_csv(getErrorFilepath(outFilepath),dtype=str))
+            else:
+                errorDFs.append(ps.DataFrame({'filename':files,'error':"lease failed: " + str(error)}))
+        prefix = self.outFolder + "/" + STAGE_PREFIXES[stage] + "_merged"
+        mergedFilepath = None
+        if(len(leaseFilepaths) > 0):
+            extension = os.path.splitext(leaseFilepaths[0])[1]
+            mergedFilepath = prefix + extension
+            if extension in COLUMNAR_EXTENSIONS:
+                tables = [readResultFile(filepath) for filepath in leaseFilepaths]
+                sink = ResultSink(mergedFilepath,tables[0].column_names)
+                for table in tables:
+                    sink.writeDataFrame(table.to_pandas())
+                sink.close()
+            else:
+                concatCsvFiles(leaseFilepaths,mergedFilepath)
+        errorDF = ps.concat(errorDFs,ignore_index=True) if len(errorDFs) > 0 else ps.DataFrame(columns=['filename','error'])
+        BatchRunner.writeShardCsv(errorDF,self.outFolder + "/errors/" + STAGE_PREFIXES[stage] + "_merged_errors.csv")
+        if debug:
+            print("merged %i %s leases into %s, %i images failed" %(len(leaseFilepaths),stage,mergedFilepath,len(errorDF)))
+        return(mergedFilepath)
+
+def main():
+    parser = argparse.ArgumentParser(description="process image sets with workers sharing a sqlite work queue")
+    parser.add_argument('command',choices=['submit','worker','merge','run'],
+                        help="submit leases, run one worker, merge finished stages, or do all three with local workers")
+    parser.add_argument('--queue',required=True,help="filepath of the sqlite work queue")
+    parser.add_argument('--imgFolder',required=True,help="folder containing .jpg images")
+    parser.add_argument('--npyFolder',required=True,help="folder containing PSPNet .npy predictions")
+    parser.add_argument('--outFolder',required=True,help="folder where lease and merged outputs are written")
+    parser.add_argument('--stages',nargs='+',default=['spatial','green'],choices=['spatial','green'],
+                        help="stages to submit or merge")
+    parser.add_argument('--leaseSize',type=int,default=1000,help="number of images per lease")
+    parser.add_argument('--leaseSeconds',type=float,default=600,help="seconds until an unrenewed lease expires")
+    parser.add_argument('--maxAttempts',type=int,default=3,help="number of claims before a lease is marked as failed")
+    parser.add_argument('--outputFormat',default='csv',choices=['csv','parquet','arrow'],help="format of output files")
+    parser.add_argument('--numWorkers',type=int,default=None,help="number of local workers for the run command")
+    parser.add_argument('--queueDepth',type=int,default=0,help="image prefetch depth per worker")
+    parser.add_argument('--numThreads',type=int,default=1,help="number of image reader threads per worker")
+    parser.add_argument('--labelStoreFolder',default=None,help="folder of a packed label store")
+    parser.add_argument('--featureCache',default=None,help="filepath of a label and pair count cache")
+    parser.add_argument('--categories',default=None,help="filepath of a json file of custom composite categories")
+    parser.add_argument('--debug',action='store_true',help="print progress updates")
+    args = parser.parse_args()
+
+    runner = DistributedRunner(args.imgFolder,args.npyFolder,args.outFolder,args.queue,args.leaseSize,args.leaseSeconds,
+                               args.maxAttempts,args.outputFormat,args.queueDepth,args.numThreads,
+                               args.labelStoreFolder,args.featureCache,args.categories)
+    if args.command in ['submit','run']:
+        if 'spatial' in args.stages:
+            print("%i spatial leases" %(runner.submitSpatial()))
+        if 'green' in args.stages:
+            print("%i green leases" %(runner.submitGreen()))
+    if(args.command == 'worker'):
+        numCompleted = runQueueWorker(*runner.getWorkerArgs(args.debug))
+        print("completed %i leases" %(numCompleted))
+    if(args.command == 'run'):
+        runner.runLocalWorkers(args.numWorkers,args.debug)
+    if args.command in ['merge','run']:
+        for stage in args.stages:
+            runner.mergeStage(stage,debug=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import time
+import sqlite3
+import numpy as np
+
+# on-disk cache of per-image label and pair counts, keyed by a hash of image content and processing
+# configuration (see ImgFeatures.calcContentHash).  Statistics for any category definition can be derived
+# from the cached counts, so changing composite categories doesn't require reloading images.  Pair counts are
+# stored sparsely.  When the cache exceeds its size limit, the least recently used entries are evicted.  The
+# cache can be shared by several worker processes: writes are held in memory and flushed in short
+# transactions, so the database is never locked while images are being processed
+class FeatureCache:
+
+    # INPUTS:
+    #    dbFilepath (str) - absolute filepath of the sqlite cache.  Created if it doesn't exist
+    #    maxBytes (int) - maximum size of cached counts, in bytes, across all processes sharing the cache
+    #    commitInterval (int) - number of cache operations held in memory before they are written to the database
+    def __init__(self,dbFilepath,maxBytes=2**33,commitInterval=100):
+        self.dbFilepath = dbFilepath
+        self.maxBytes = maxBytes
+        self.commitInterval = commitInterval
+        self.pendingCounts = {}
+        self.pendingFiles = []
+        self.pendingHits = {}
+        self.conn = sqlite3.connect(dbFilepath,timeout=60,isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS counts (key TEXT PRIMARY KEY, labelCounts BLOB, pairIndex BLOB, " +
+            "pairValues BLOB, numBytes INTEGER, lastUsed REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS countsLastUsed ON counts (lastUsed)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files (stage TEXT, filename TEXT, key TEXT, PRIMARY KEY (stage, filename))"
+        )
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    # write pending operations in a single short transaction, and evict entries if the cache is over its size limit
+    def commit(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.executemany("INSERT OR REPLACE INTO counts VALUES (?,?,?,?,?,?)",list(self.pendingCounts.values()))
+            self.conn.executemany("UPDATE counts SET lastUsed = ? WHERE key = ?",
+                                  [(lastUsed,key) for key, lastUsed in self.pendingHits.items()])
+            self.conn.executemany("INSERT OR REPLACE INTO files VALUES (?,?,?)",self.pendingFiles)
+            self.evict()
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.pendingCounts = {}
+        self.pendingFiles = []
+        self.pendingHits = {}
+
+    # commit once commitInterval operations are pending
+    def recordOp(self):
+        if(len(self.pendingCounts) + len(self.pendingFiles) + len(self.pendingHits) >= self.commitInterval):
+            self.commit()
+
+    # convert a cached row to counts
+    # INPUTS:
+    #    row (tuple) - label counts, pair index, and pair value blobs
+    # OUTPUTS:
+    #    (tuple) - label counts and (labels x labels) pair counts
+    def decodeCounts(self,row):
+        labelCounts = np.frombuffer(row[0],dtype=np.int64)
+        numLabels = labelCounts.shape[0]
+        pairCounts = np.zeros(numLabels*numLabels,dtype=np.int64)
+        pairCounts[np.frombuffer(row[1],dtype=np.int32)] = np.frombuffer(row[2],dtype=np.int64)
+        return((labelCounts,pairCounts.reshape((numLabels,numLabels))))
+
+    # get cached counts
+    # INPUTS:
+    #    key (str) - content and configuration hash
+    # OUTPUTS:
+    #    (tuple) - label counts and (labels x labels) pair counts, or None if the key isn't cached
+    def get(self,key):
+        if key in self.pendingCounts:
+            return(self.decodeCounts(self.pendingCounts[key][1:4]))
+        row = self.conn.execute(
+            "SELECT labelCounts, pairIndex, pairValues FROM counts WHERE key = ?",(key,)
+        ).fetchone()
+        if row is None:
+            return(None)
+        self.pendingHits[key] = time.time()
+        self.recordOp()
+        return(self.decodeCounts(row))
+
+    # add counts to the cache
+    # INPUTS:
+    #    key (str) - content and configuration hash
+    #    labelCounts (int array) - number of pixels for each label
+    #    pairCounts (2d int matrix) - number of neighboring pixel pairs for each combination of labels
+    def put(self,key,labelCounts,pairCounts):
+        flatPairs = np.asarray(pairCounts).ravel()
+        pairIndex = np.flatnonzero(flatPairs).astype(np.int32)
+        labelBlob = np.asarray(labelCounts,dtype=np.int64).tobytes()
+        indexBlob = pairIndex.tobytes()
+        valueBlob = flatPairs[pairIndex].astype(np.int64).tobytes()
+        numBytes = len(labelBlob) + len(indexBlob) + len(valueBlob)
+        self.pendingCounts[key] = (key,labelBlob,indexBlob,valueBlob,numBytes,time.time())
+        self.recordOp()
+
+    # evict least recently used entries until the cache is within its size limit.  The cache size is read from the
+    # database, so entries added by all processes sharing the cache are included.  Called within commit
+    def evict(self):
+        totalBytes = self.conn.execute("SELECT COALESCE(SUM(numBytes),0) FROM counts").fetchone()[0]
+        if(totalBytes <= self.maxBytes):
+            return
+        excessBytes = totalBytes - self.maxBytes
+        keysToEvict = []
+        freedBytes = 0
+        for key, numBytes in self.conn.execute("SELECT key, numBytes FROM counts ORDER BY lastUsed"):
+            keysToEvict.append((key,))
+            freedBytes += numBytes
+            if(freedBytes >= excessBytes):
+                break
+        self.conn.executemany("DELETE FROM counts WHERE key = ?",keysToEvict)
+
+    # record which cache key holds the counts for a file
+    # INPUTS:
+    #    stage (str) - name of the processing stage, e.g. 'spatial' or 'green'
+    #    filename (str) - relative filepath of the image
+    #    key (str) - content and configuration hash
+    def recordFile(self,stage,filename,key):
+        self.pendingFiles.append((stage,filename,key))
+        self.recordOp()
+
+    # get the cache keys of all files recorded for a stage, including files that haven't been committed yet
+    # INPUTS:
+    #    stage (str) - name of the processing stage
+    # OUTPUTS:
+    #    (dictionary) - key-value pairs of filename and cache key
+    def getFileKeys(self,stage):
+        fileKeys = dict(self.conn.execute("SELECT filename, key FROM files WHERE stage = ?",(stage,)).fetchall())
+        for fileStage, filename, key in self.pendingFiles:
+            if(fileStage == stage):
+                fileKeys[filename] = key
+        return(fileKeys)
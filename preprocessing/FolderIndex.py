@@ -0,0 +1,86 @@
+import os
+import time
+import sqlite3
+
+# lazily built index of the filenames in a folder.  The folder is not read until filenames are first needed,
+# and is then listed with a single os.scandir pass (no per-file stat calls) into a list and a hashed set, so
+# membership lookups take O(1) time.  If an index filepath is provided, the listing is saved in a sqlite file
+# along with the folder's modification time, and reused by later runs until files are added to or removed
+# from the folder
+class FolderIndex:
+
+    # INPUTS:
+    #    folder (str) - absolute filepath of the folder to index
+    #    extension (str) - only filenames ending with the extension are indexed (e.g. '.npy').  Defaults to all
+    #    indexFilepath (str) - optional.  Absolute filepath of the sqlite file where listings are saved between
+    #                          runs.  Can be shared by several folders
+    def __init__(self,folder,extension='',indexFilepath=None):
+        self.folder = os.path.abspath(folder)
+        self.extension = extension
+        self.indexFilepath = indexFilepath
+        self.files = None
+        self.fileSet = None
+
+    # list the folder with a single directory scan
+    # OUTPUTS:
+    #    (str list) - filenames in the folder ending with the extension
+    def scanFolder(self):
+        with os.scandir(self.folder) as entries:
+            return([entry.name for entry in entries if entry.name.endswith(self.extension)])
+
+    # load the saved listing if the folder hasn't changed since it was saved, and otherwise rescan the folder.
+    # Folders modified less than two seconds before a scan may change again without a new modification time,
+    # so their listings are saved as out of date and rescanned by the next run
+    def load(self):
+        folderMtime = os.stat(self.folder).st_mtime_ns
+        if self.indexFilepath is None:
+            self.files = self.scanFolder()
+            return
+        conn = sqlite3.connect(self.indexFilepath,timeout=60)
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS folders (folder TEXT, extension TEXT, mtime INTEGER, names BLOB, " +
+                "PRIMARY KEY (folder, extension))"
+            )
+            row = conn.execute(
+                "SELECT mtime, names FROM folders WHERE folder = ? AND extension = ?",(self.folder,self.extension)
+            ).fetchone()
+            if row is not None and row[0] == folderMtime:
+                self.files = row[1].decode('utf-8').split('\0') if len(row[1]) > 0 else []
+                return
+            scanTime = time.time_ns()
+            self.files = self.scanFolder()
+            savedMtime = folderMtime if scanTime - folderMtime > 2*10**9 else -1
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO folders VALUES (?,?,?,?)",
+                    (self.folder,self.extension,savedMtime,'\0'.join(self.files).encode('utf-8'))
+                )
+        finally:
+            conn.close()
+
+    # discard the in-memory listing, so it is reloaded (and rescanned if the folder changed) when next needed
+    def refresh(self):
+        self.files = None
+        self.fileSet = None
+
+    # get all indexed filenames
+    # OUTPUTS:
+    #    (str list) - filenames in the folder ending with the extension, in directory order
+    def getFiles(self):
+        if self.files is None:
+            self.load()
+        return(self.files)
+
+    # check whether a file is in the folder
+    # INPUTS:
+    #    filename (str) - relative filepath of the file
+    # OUTPUTS:
+    #    (boolean) - True if the filename is indexed
+    def contains(self,filename):
+        if self.fileSet is None:
+            self.fileSet = set(self.getFiles())
+        return(filename in self.fileSet)
+
+    def __len__(self):
+        return(len(self.getFiles()))
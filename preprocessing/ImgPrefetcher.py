@@ -0,0 +1,93 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# load images ahead of processing with a pool of reader threads.  Up to queueDepth images are read and
+# decoded in the background while the current image is processed, hiding file system latency (e.g. on
+# network mounted image folders).  Image decoding in cv2 and file reads in numpy release the GIL, so
+# reader threads run in parallel with processing.  Time spent waiting for images is recorded as stall time
+class ImgPrefetcher:
+
+    # INPUTS:
+    #    queueDepth (int) - maximum number of images loaded ahead of processing.  If 0, images are
+    #                       loaded serially in the processing thread
+    #    numThreads (int) - number of reader threads
+    #    stopEvent (threading.Event) - optional.  If set while items are being iterated, iteration stops with an
+    #                                  InterruptedError before the next item, e.g. when a worker loses its lease
+    def __init__(self,queueDepth=8,numThreads=4,stopEvent=None):
+        self.queueDepth = queueDepth
+        self.numThreads = numThreads
+        self.stopEvent = stopEvent
+        self.stallTime = 0.0
+        self.numLoaded = 0
+        self.numFailed = 0
+
+    # load one item, capturing any error raised while loading
+    # INPUTS:
+    #    loadFunction (function) - function that loads the data for one item
+    #    item (object) - item to load, e.g. a filename
+    # OUTPUTS:
+    #    (tuple) - loaded data (None if loading failed) and the exception raised while loading (None if successful)
+    def loadOne(self,loadFunction,item):
+        try:
+            return((loadFunction(item),None))
+        except Exception as e:
+            return((None,e))
+
+    # update load counters and stall time after waiting for an item
+    def recordLoad(self,startTime,error):
+        self.stallTime += time.perf_counter() - startTime
+        if error is None:
+            self.numLoaded += 1
+        else:
+            self.numFailed += 1
+
+    # raise an InterruptedError if the stop event has been set
+    def checkStopped(self):
+        if(self.stopEvent is not None and self.stopEvent.is_set()):
+            raise InterruptedError("image loading was stopped")
+
+    # iterate over loaded items, in the same order as the input items
+    # INPUTS:
+    #    loadFunction (function) - function that loads the data for one item
+    #    items (list) - items to load, e.g. filenames
+    # OUTPUTS:
+    #    (generator) - tuples of item, loaded data, and the exception raised while loading (None if successful)
+    def iterate(self,loadFunction,items):
+        if(self.queueDepth <= 0):
+            for item in items:
+                startTime = time.perf_counter()
+                data, error = self.loadOne(loadFunction,item)
+                self.recordLoad(startTime,error)
+                self.checkStopped()
+                yield((item,data,error))
+            return
+        itemIter = iter(items)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.numThreads) as executor:
+            for item in itemIter:
+                pending.append((item,executor.submit(self.loadOne,loadFunction,item)))
+                if(len(pending) >= self.queueDepth):
+                    break
+            while(len(pending) > 0):
+                item, future = pending.popleft()
+                startTime = time.perf_counter()
+                data, error = future.result()
+                self.recordLoad(startTime,error)
+                for nextItem in itemIter:
+                    pending.append((nextItem,executor.submit(self.loadOne,loadFunction,nextItem)))
+                    break
+                self.checkStopped()
+                yield((item,data,error))
+
+    # summarize loading statistics
+    # OUTPUTS:
+    #    (dictionary) - number of loaded and failed items, and seconds spent waiting on loads
+    def getStats(self):
+        return({
+            'queueDepth':self.queueDepth,
+            'numThreads':self.numThreads,
+            'numLoaded':self.numLoaded,
+            'numFailed':self.numFailed,
+            'stallTime':self.stallTime
+        })
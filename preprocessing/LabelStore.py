@@ -0,0 +1,97 @@
+import os
+import numpy as np
+import pandas as ps
+
+# PSPNet predictions packed into a few large uint8 shard files, with an index of the shard, byte offset,
+# and shape of each image.  Shards are memory mapped, so labels are read without opening a file per image
+# and without copying.  Stores are created from a folder of .npy files with packLabelStore
+class LabelStore:
+
+    # INPUTS:
+    #    storeFolder (str) - absolute filepath to folder containing shard files and the store index
+    def __init__(self,storeFolder):
+        self.storeFolder = storeFolder
+        indexDF = ps.read_csv(storeFolder + "/index.csv")
+        self.index = dict(zip(
+            indexDF['filename'],
+            zip(indexDF['shard'],indexDF['offset'],indexDF['height'],indexDF['width'])
+        ))
+        self.shards = {}
+
+    def __contains__(self,filename):
+        return(filename in self.index)
+
+    def __len__(self):
+        return(len(self.index))
+
+    # get the filenames of all images in the store
+    # OUTPUTS:
+    #    (str list) - relative filepaths of the original .npy files
+    def getFilenames(self):
+        return(list(self.index.keys()))
+
+    # get a memory map of a shard file.  Shards are mapped the first time they are accessed
+    # INPUTS:
+    #    shardNum (int) - shard number
+    # OUTPUTS:
+    #    (1d uint8 memmap) - contents of the shard file
+    def getShard(self,shardNum):
+        if shardNum not in self.shards:
+            self.shards[shardNum] = np.memmap(self.storeFolder + "/labels_" + str(shardNum) + ".bin",dtype=np.uint8,mode='r')
+        return(self.shards[shardNum])
+
+    # load PSPNet labels for one image
+    # INPUTS:
+    #    filename (str) - relative filepath of the original .npy file
+    # OUTPUTS:
+    #    (2d uint8 array) - read only view of PSPNet class labels for all pixels in the image
+    def loadLabels(self,filename):
+        if filename not in self.index:
+            raise IOError("%s is not in the label store %s" %(filename,self.storeFolder))
+        shardNum, offset, height, width = self.index[filename]
+        return(self.getShard(shardNum)[offset:offset + height*width].reshape((height,width)))
+
+# pack a folder of PSPNet .npy predictions into a label store
+# INPUTS:
+#    npyFolder (str) - absolute filepath to folder containing PSPNet .npy predictions
+#    storeFolder (str) - absolute filepath to folder where shard files and the store index are written
+#    shardBytes (int) - approximate maximum size of each shard file, in bytes
+#    files (str list) - optional.  Relative filepaths of .npy files to pack.  Defaults to all .npy files in npyFolder
+#    debug (boolean) - whether or not to print progress updates
+# OUTPUTS:
+#    errors (list) - (filename, error message) tuples for files that could not be packed
+def packLabelStore(npyFolder,storeFolder,shardBytes=2**30,files=None,debug=False):
+    if files is None:
+        files = [file for file in os.listdir(npyFolder) if file[-4:] == '.npy']
+    if not os.path.exists(storeFolder):
+        os.makedirs(storeFolder)
+    indexRows = []
+    errors = []
+    shardNum = 0
+    offset = 0
+    shardFile = open(storeFolder + "/labels_0.bin",'wb')
+    for filename in files:
+        try:
+            labels = np.load(npyFolder + "/" + filename)
+            if(labels.ndim != 2 or labels.min() < 0 or labels.max() > 255):
+                raise ValueError("labels must be a 2d array with values between 0 and 255")
+        except Exception as e:
+            errors.append((filename,str(e)))
+            continue
+        if(offset > 0 and offset + labels.size > shardBytes):
+            shardFile.close()
+            shardNum += 1
+            offset = 0
+            shardFile = open(storeFolder + "/labels_" + str(shardNum) + ".bin",'wb')
+        shardFile.write(np.ascontiguousarray(labels,dtype=np.uint8).tobytes())
+        indexRows.append((filename,shardNum,offset,labels.shape[0],labels.shape[1]))
+        offset += labels.size
+        if(debug and len(indexRows)%10000 == 0):
+            print("packed %i images" %(len(indexRows)))
+    shardFile.close()
+    indexDF = ps.DataFrame(indexRows,columns=['filename','shard','offset','height','width'])
+    indexDF.to_csv(storeFolder + "/index.csv.tmp",index=False)
+    os.replace(storeFolder + "/index.csv.tmp",storeFolder + "/index.csv")
+    if debug:
+        print("packed %i images into %i shards. %i images could not be packed" %(len(indexRows),shardNum+1,len(errors)))
+    return(errors)
@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as ps
+
+# preallocated, column oriented storage for per-image statistics.  Numeric values are stored in a
+# (columns x images) float array and filenames in a separate list, so statistics are never converted
+# to strings.  Capacity doubles when full, so appending n images costs O(n) time and memory
+class ResultBuffer:
+
+    # INPUTS:
+    #    header (str list) - output column names, including the filename column
+    #    capacity (int) - number of images to preallocate space for
+    #    dtype (numpy dtype) - numeric type of the statistic columns (e.g. np.float32, np.float64)
+    #    filenameCol (str) - name of the filename column within the header
+    def __init__(self,header,capacity=1024,dtype=np.float64,filenameCol='filename'):
+        self.header = list(header)
+        self.filenameCol = filenameCol
+        self.valueCols = [col for col in self.header if col != filenameCol]
+        self.values = np.empty((len(self.valueCols),max(capacity,1)),dtype=dtype)
+        self.filenames = []
+        self.numRows = 0
+
+    # add statistics for one image
+    # INPUTS:
+    #    filename (str) - image filename
+    #    rowValues (float array) - statistics for the image, in the order of the non-filename header columns
+    def append(self,filename,rowValues):
+        self.appendBatch([filename],np.asarray(rowValues).reshape((1,-1)))
+
+    # add statistics for several images
+    # INPUTS:
+    #    filenames (str list) - image filenames
+    #    batchValues (2d float matrix) - statistics with one row per image, in the order of the non-filename
+    #                                    header columns
+    def appendBatch(self,filenames,batchValues):
+        numNew = len(filenames)
+        capacity = self.values.shape[1]
+        while(self.numRows + numNew > capacity):
+            capacity *= 2
+        if(capacity > self.values.shape[1]):
+            grown = np.empty((self.values.shape[0],capacity),dtype=self.values.dtype)
+            grown[:,:self.numRows] = self.values[:,:self.numRows]
+            self.values = grown
+        self.values[:,self.numRows:self.numRows + numNew] = np.asarray(batchValues).T
+        self.filenames += list(filenames)
+        self.numRows += numNew
+
+    # remove all stored images, keeping the allocated capacity.  Used after results are written to a ResultSink
+    def clear(self):
+        self.filenames = []
+        self.numRows = 0
+
+    def __len__(self):
+        return(self.numRows)
+
+    # convert stored statistics to a dataframe.  Statistic columns are views of the buffer, not copies
+    # OUTPUTS:
+    #    resultsDataframe (pandas dataframe) - one row per image, with columns in header order
+    def toDataFrame(self):
+        resultsDataframe = ps.DataFrame(
+            self.values[:,:self.numRows].T,columns=self.valueCols,copy=False
+        )
+        if self.filenameCol in self.header:
+            resultsDataframe.insert(self.header.index(self.filenameCol),self.filenameCol,self.filenames)
+        return(resultsDataframe)
@@ -0,0 +1,141 @@
+import os
+import numpy as np
+import pandas as ps
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# file extensions of the columnar formats written by ResultSink
+COLUMNAR_EXTENSIONS = ('.parquet','.arrow')
+
+def checkPyarrow():
+    if pa is None:
+        raise ImportError("pyarrow is required for parquet and arrow result files.  Install it with 'pip install pyarrow'")
+
+# make repeated column names unique in the same way as pandas.read_csv, e.g. the second 'tree_ratio' column
+# in the spatial header becomes 'tree_ratio.1', so columnar and csv results load with the same column names
+# INPUTS:
+#    header (str list) - column names, possibly repeated
+# OUTPUTS:
+#    uniqueNames (str list) - unique column names
+def createUniqueColumnNames(header):
+    numRepeats = {}
+    uniqueNames = []
+    for col in header:
+        if col in numRepeats:
+            numRepeats[col] += 1
+            uniqueNames.append(col + "." + str(numRepeats[col]))
+        else:
+            numRepeats[col] = 0
+            uniqueNames.append(col)
+    return(uniqueNames)
+
+# streams per-image statistics to a parquet or arrow ipc file as row groups, instead of building one large
+# dataframe and formatting it as csv.  Statistic columns are stored as typed floats, the filename column is
+# dictionary encoded, and repeated column names are made unique (see createUniqueColumnNames).  The file is
+# written under a temporary name and renamed when closed, so partially written files are never mistaken for
+# completed ones.  The format is chosen by the file extension
+class ResultSink:
+
+    # INPUTS:
+    #    filepath (str) - absolute filepath of the output file, ending in .parquet or .arrow.  Arrow files use the
+    #                     ipc stream format, which allows each row group to have its own filename dictionary
+    #    header (str list) - output column names, including the filename column, in the order of the results
+    #    dtype (numpy dtype) - numeric type of the statistic columns in the output file
+    #    filenameCol (str) - name of the filename column within the header
+    #    rowGroupSize (int) - number of images per row group.  Drivers write results to the sink each time
+    #                         this many images have been processed
+    def __init__(self,filepath,header,dtype=np.float32,filenameCol='filename',rowGroupSize=8192):
+        checkPyarrow()
+        if not filepath.endswith(COLUMNAR_EXTENSIONS):
+            raise ValueError("result sink filepath must end with one of %s" %(str(COLUMNAR_EXTENSIONS)))
+        self.filepath = filepath
+        self.tempFilepath = filepath + ".tmp"
+        self.header = list(header)
+        self.dtype = np.dtype(dtype)
+        self.filenameCol = filenameCol
+        self.rowGroupSize = rowGroupSize
+        self.numRows = 0
+        fields = []
+        for col, uniqueCol in zip(self.header,createUniqueColumnNames(self.header)):
+            if(col == filenameCol):
+                fields.append(pa.field(uniqueCol,pa.dictionary(pa.int32(),pa.string())))
+            else:
+                fields.append(pa.field(uniqueCol,pa.from_numpy_dtype(self.dtype)))
+        self.schema = pa.schema(fields)
+        if filepath.endswith('.parquet'):
+            self.writer = pq.ParquetWriter(self.tempFilepath,self.schema)
+        else:
+            self.outFile = pa.OSFile(self.tempFilepath,'wb')
+            self.writer = pa.ipc.new_stream(self.outFile,self.schema)
+
+    # write the images held in a result buffer as one row group.  The buffer is not cleared
+    # INPUTS:
+    #    buffer (ResultBuffer) - statistics to write.  Must have the same header as the sink
+    def writeBuffer(self,buffer):
+        if(len(buffer) == 0):
+            return
+        columns = []
+        valueIndex = 0
+        for col in self.header:
+            if(col == self.filenameCol):
+                columns.append(pa.array([str(filename) for filename in buffer.filenames],pa.string()).dictionary_encode())
+            else:
+                colValues = buffer.values[valueIndex,:buffer.numRows]
+                columns.append(pa.array(colValues.astype(self.dtype,copy=False)))
+                valueIndex += 1
+        self.writer.write_table(pa.Table.from_arrays(columns,schema=self.schema))
+        self.numRows += len(buffer)
+
+    # write a dataframe with the same columns as the sink as one row group
+    # INPUTS:
+    #    dataframe (pandas dataframe) - statistics to write, with columns in header order
+    def writeDataFrame(self,dataframe):
+        columns = []
+        for colIndex, col in enumerate(self.header):
+            colValues = dataframe.iloc[:,colIndex]
+            if(col == self.filenameCol):
+                columns.append(pa.array(colValues.astype(str).tolist(),pa.string()).dictionary_encode())
+            else:
+                columns.append(pa.array(colValues.to_numpy().astype(self.dtype,copy=False)))
+        self.writer.write_table(pa.Table.from_arrays(columns,schema=self.schema))
+        self.numRows += len(dataframe)
+
+    # finish writing and rename the temporary file to the output filepath
+    def close(self):
+        self.writer.close()
+        if not self.filepath.endswith('.parquet'):
+            self.outFile.close()
+        os.replace(self.tempFilepath,self.filepath)
+
+# read one parquet or arrow result file.  Arrow files are memory mapped, so columns are not copied
+# INPUTS:
+#    filepath (str) - absolute filepath of the result file
+#    columns (str list) - optional.  Names of the columns to read, see createUniqueColumnNames.  Defaults to all columns
+# OUTPUTS:
+#    (pyarrow table) - contents of the file
+def readResultFile(filepath,columns=None):
+    checkPyarrow()
+    if filepath.endswith('.parquet'):
+        return(pq.read_table(filepath,columns=columns,memory_map=True))
+    table = pa.ipc.open_stream(pa.memory_map(filepath,'r')).read_all()
+    if columns is not None:
+        table = table.select(columns)
+    return(table)
+
+# load all parquet and arrow result files in a folder into a single dataframe.  Files are combined as arrow
+# tables, so data is copied once when converting to pandas rather than once per file
+# INPUTS:
+#    resultFolder (str) - absolute filepath to folder containing result files
+#    columns (str list) - optional.  Names of the columns to read, see createUniqueColumnNames.  Defaults to all columns
+# OUTPUTS:
+#    (pandas dataframe) - contents of all result files.  Empty if the folder has no result files
+def loadResultFiles(resultFolder,columns=None):
+    filesToLoad = [file for file in sorted(os.listdir(resultFolder)) if file.endswith(COLUMNAR_EXTENSIONS)]
+    if(len(filesToLoad) == 0):
+        return(ps.DataFrame())
+    tables = [readResultFile(resultFolder + "/" + file,columns) for file in filesToLoad]
+    return(pa.concat_tables(tables).to_pandas(split_blocks=True))
@@ -0,0 +1,112 @@
+import os
+import sqlite3
+import pandas as ps
+
+# persistent record of which images have been processed for each processing stage (e.g. 'spatial',
+# 'green').  Images are keyed by filename, file size, and modification time, so an image that changes
+# on disk after being processed is treated as unprocessed.  Remaining work after a restart is found
+# with a single hashed pass over the candidate files, instead of rescanning previous csv outputs
+class RunManifest:
+
+    # INPUTS:
+    #    dbFilepath (str) - absolute filepath of the sqlite manifest.  Created if it doesn't exist
+    def __init__(self,dbFilepath):
+        self.dbFilepath = dbFilepath
+        self.conn = sqlite3.connect(dbFilepath)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS images (stage TEXT, filename TEXT, size INTEGER, mtime REAL, " +
+            "status TEXT, error TEXT, PRIMARY KEY (stage, filename))"
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    # get the size and modification time of all files in a folder with a single directory scan
+    # INPUTS:
+    #    folder (str) - absolute filepath of folder to scan
+    #    extension (str) - only files ending with the extension are included (e.g. 'npy')
+    # OUTPUTS:
+    #    candidates (dictionary) - key-value pairs of filename and (size, mtime)
+    def scanFolder(self,folder,extension=''):
+        candidates = {}
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.endswith(extension) and entry.is_file():
+                    fileStat = entry.stat()
+                    candidates[entry.name] = (fileStat.st_size,fileStat.st_mtime)
+        return(candidates)
+
+    # identify candidate files that still need to be processed for a stage
+    # INPUTS:
+    #    stage (str) - name of the processing stage
+    #    candidates (dictionary) - key-value pairs of filename and (size, mtime), see scanFolder
+    #    retryFailed (boolean) - whether unchanged files that previously failed should be processed again
+    # OUTPUTS:
+    #    filesToProcess (str list) - candidate filenames that have not been processed in their current state
+    def getRemaining(self,stage,candidates,retryFailed=False):
+        statuses = ('done',) if retryFailed else ('done','failed')
+        recorded = {}
+        cursor = self.conn.execute(
+            "SELECT filename, size, mtime FROM images WHERE stage = ? AND status IN (%s)" %(",".join("?"*len(statuses))),
+            (stage,) + statuses
+        )
+        for filename, size, mtime in cursor:
+            recorded[filename] = (size,mtime)
+        filesToProcess = [filename for filename, fileStat in candidates.items() if recorded.get(filename) != fileStat]
+        return(filesToProcess)
+
+    # record the processing status of a set of files
+    # INPUTS:
+    #    stage (str) - name of the processing stage
+    #    folder (str) - absolute filepath of folder containing the files
+    #    filenames (str list) - relative filepaths of processed files
+    #    status (str) - processing status, e.g. 'done' or 'failed'
+    #    errors (str list) - optional.  Error message for each file
+    def recordFiles(self,stage,folder,filenames,status,errors=None):
+        if errors is None:
+            errors = [None]*len(filenames)
+        rows = []
+        for filename, error in zip(filenames,errors):
+            try:
+                fileStat = os.stat(folder + "/" + filename)
+                rows.append((stage,filename,fileStat.st_size,fileStat.st_mtime,status,error))
+            except OSError:
+                rows.append((stage,filename,None,None,status,error))
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO images VALUES (?,?,?,?,?,?)",rows)
+
+    # record the results of a processed shard
+    # INPUTS:
+    #    stage (str) - name of the processing stage
+    #    folder (str) - absolute filepath of folder containing the files
+    #    files (str list) - relative filepaths of all files in the shard
+    #    errors (list) - (filename, error message) tuples for files that could not be processed
+    def recordShard(self,stage,folder,files,errors):
+        failed = set([error[0] for error in errors])
+        self.recordFiles(stage,folder,[filename for filename in files if filename not in failed],'done')
+        self.recordFiles(stage,folder,[error[0] for error in errors],'failed',[error[1] for error in errors])
+
+    # seed the manifest from csv outputs written before the manifest existed.  Only the filename
+    # column of each csv is read
+    # INPUTS:
+    #    stage (str) - name of the processing stage
+    #    resultFolder (str) - folder containing previous csv outputs
+    #    folder (str) - absolute filepath of folder containing the processed files
+    #    filenameCol (str) - name of the filename column in the csv outputs
+    #    extension (str) - appended to csv filenames that were stored without an extension (e.g. '.jpg')
+    def importResultFiles(self,stage,resultFolder,folder,filenameCol='filename',extension=''):
+        for file in os.listdir(resultFolder):
+            if file[-4:] != '.csv':
+                continue
+            filenames = ps.read_csv(resultFolder + "/" + file,usecols=[filenameCol])[filenameCol]
+            self.recordFiles(stage,folder,[str(filename) + extension for filename in filenames],'done')
+
+    # summarize processing status for a stage
+    # INPUTS:
+    #    stage (str) - name of the processing stage
+    # OUTPUTS:
+    #    (dictionary) - key-value pairs of status and number of files
+    def getStatusCounts(self,stage):
+        cursor = self.conn.execute("SELECT status, COUNT(*) FROM images WHERE stage = ? GROUP BY status",(stage,))
+        return(dict(cursor.fetchall()))
@@ -0,0 +1,133 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# opt-in timing and counters for image processing stages (e.g. jpg decoding, green screening, label
+# counting).  Seconds and calls are accumulated per stage, alongside counters such as images processed and
+# bytes read, and failures by cause.  Metrics are available as a dictionary, and can be printed as a json
+# line at a fixed interval during long runs.  A disabled profiler records nothing, so instrumented code can
+# call it unconditionally.  Stages timed in image reader threads (see ImgPrefetcher) overlap with
+# processing, so the time spent waiting on loads is recorded separately as the 'loadStall' stage
+class StageProfiler:
+
+    # INPUTS:
+    #    enabled (boolean) - whether or not to record metrics
+    #    logInterval (float) - optional.  Seconds between json log lines written by logIfDue.  If None, no
+    #                          lines are written
+    #    logFile (file) - optional.  Open file that json log lines are written to.  Defaults to stdout
+    def __init__(self,enabled=True,logInterval=None,logFile=None):
+        self.enabled = enabled
+        self.logInterval = logInterval
+        self.logFile = logFile
+        self.lock = threading.Lock()
+        self.reset()
+
+    # clear all recorded metrics and restart the run clock
+    def reset(self):
+        self.startTime = time.perf_counter()
+        self.lastLogTime = self.startTime
+        self.stageSeconds = {}
+        self.stageCalls = {}
+        self.counters = {}
+        self.failures = {}
+
+    # time a stage
+    # INPUTS:
+    #    stage (str) - stage name
+    @contextmanager
+    def time(self,stage):
+        if not self.enabled:
+            yield
+            return
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addTime(stage,time.perf_counter() - startTime)
+
+    # add time to a stage that was measured elsewhere (e.g. ImgPrefetcher stall time)
+    # INPUTS:
+    #    stage (str) - stage name
+    #    seconds (float) - seconds spent in the stage
+    #    calls (int) - number of calls to the stage
+    def addTime(self,stage,seconds,calls=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.stageSeconds[stage] = self.stageSeconds.get(stage,0.0) + seconds
+            self.stageCalls[stage] = self.stageCalls.get(stage,0) + calls
+
+    # increment a counter
+    # INPUTS:
+    #    name (str) - counter name, e.g. 'imgsProcessed' or 'bytesRead'
+    #    amount (int) - amount to add
+    def count(self,name,amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name,0) + amount
+
+    # record a failed image.  Failures are grouped by exception type
+    # INPUTS:
+    #    error (Exception or str) - exception raised while processing the image, or a description of the failure
+    def recordFailure(self,error):
+        if not self.enabled:
+            return
+        cause = type(error).__name__ if isinstance(error,Exception) else str(error)
+        with self.lock:
+            self.failures[cause] = self.failures.get(cause,0) + 1
+
+    # summarize recorded metrics
+    # OUTPUTS:
+    #    (dictionary) - elapsed seconds, images/sec, counters, failures by cause, and seconds, calls, and share of
+    #                   elapsed time for each stage
+    def getMetrics(self):
+        with self.lock:
+            elapsed = time.perf_counter() - self.startTime
+            stages = {}
+            for stage in self.stageSeconds.keys():
+                stages[stage] = {
+                    'seconds':self.stageSeconds[stage],
+                    'calls':self.stageCalls[stage],
+                    'fractionOfElapsed':self.stageSeconds[stage]/elapsed if elapsed > 0 else None
+                }
+            return({
+                'pid':os.getpid(),
+                'elapsedSeconds':elapsed,
+                'imgsPerSec':self.counters.get('imgsProcessed',0)/elapsed if elapsed > 0 else None,
+                'counters':dict(self.counters),
+                'failures':dict(self.failures),
+                'stages':stages
+            })
+
+    # add metrics recorded by another profiler, e.g. one owned by a worker process
+    # INPUTS:
+    #    metrics (dictionary) - metrics returned by getMetrics
+    def merge(self,metrics):
+        if not self.enabled or metrics is None:
+            return
+        for stage, stageMetrics in metrics['stages'].items():
+            self.addTime(stage,stageMetrics['seconds'],stageMetrics['calls'])
+        for name, amount in metrics['counters'].items():
+            self.count(name,amount)
+        with self.lock:
+            for cause, numFailed in metrics['failures'].items():
+                self.failures[cause] = self.failures.get(cause,0) + numFailed
+
+    # write metrics as a single json line
+    def log(self):
+        logFile = self.logFile if self.logFile is not None else sys.stdout
+        logFile.write(json.dumps(self.getMetrics()) + "\n")
+        logFile.flush()
+
+    # write metrics as a json line if logInterval seconds have passed since the last line
+    def logIfDue(self):
+        if(not self.enabled or self.logInterval is None):
+            return
+        currentTime = time.perf_counter()
+        if(currentTime - self.lastLogTime >= self.logInterval):
+            self.lastLogTime = currentTime
+            self.log()
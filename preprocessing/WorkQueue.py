@@ -0,0 +1,173 @@
+import json
+import time
+import sqlite3
+
+# sqlite queue of leases for distributed processing (see DistributedRunner).  The file list of a processing
+# stage is partitioned into leases of consecutive files.  Workers claim a lease for a limited time and renew it
+# while processing.  Leases whose time expires (e.g. because the worker was killed) are claimed again by
+# another worker with a new attempt number.  A lease is only completed by the attempt that currently holds it,
+# so exactly one output file is recorded per lease, even if a stalled worker finishes after its lease was
+# reassigned.  Leases that fail maxAttempts times are marked as failed so a run can finish.  The queue file
+# must be on a file system with working locks, e.g. a local disk shared by several worker processes
+class WorkQueue:
+
+    # INPUTS:
+    #    dbFilepath (str) - absolute filepath of the sqlite queue.  Created if it doesn't exist
+    #    maxAttempts (int) - number of times a lease can be claimed before it is marked as failed
+    def __init__(self,dbFilepath,maxAttempts=3):
+        self.dbFilepath = dbFilepath
+        self.maxAttempts = maxAttempts
+        self.conn = sqlite3.connect(dbFilepath,timeout=60,isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases (stage TEXT, leaseIndex INTEGER, files TEXT, outputFormat TEXT, " +
+            "status TEXT, workerId TEXT, attempt INTEGER, expires REAL, outFilepath TEXT, numFailed INTEGER, " +
+            "error TEXT, PRIMARY KEY (stage, leaseIndex))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS leasesStatus ON leases (status)")
+
+    def close(self):
+        self.conn.close()
+
+    # partition files into leases for a stage.  If the stage already has leases, no leases are added, so a
+    # restarted coordinator resumes the existing run
+    # INPUTS:
+    #    stage (str) - name of the processing stage, e.g. 'spatial' or 'green'
+    #    files (str list) - relative filepaths of images to process
+    #    leaseSize (int) - number of images per lease
+    #    outputFormat (str) - format of lease output files: 'csv', 'parquet', or 'arrow'
+    # OUTPUTS:
+    #    (int) - number of leases in the stage
+    def addLeases(self,stage,files,leaseSize,outputFormat='csv'):
+        files = list(files)
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            numLeases = self.conn.execute("SELECT COUNT(*) FROM leases WHERE stage = ?",(stage,)).fetchone()[0]
+            if(numLeases == 0):
+                rows = []
+                for leaseIndex, start in enumerate(range(0,len(files),leaseSize)):
+                    rows.append((stage,leaseIndex,json.dumps(files[start:start + leaseSize]),outputFormat,'pending',
+                                 None,0,None,None,None,None))
+                self.conn.executemany("INSERT INTO leases VALUES (?,?,?,?,?,?,?,?,?,?,?)",rows)
+                numLeases = len(rows)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return(numLeases)
+
+    # claim a pending lease, or a lease whose previous holder let it expire.  Expired leases that have already
+    # been claimed maxAttempts times are marked as failed instead
+    # INPUTS:
+    #    workerId (str) - unique id of the claiming worker
+    #    leaseSeconds (float) - seconds until the lease expires unless it is renewed
+    # OUTPUTS:
+    #    (tuple) - stage, lease index, attempt number, files in the lease, and output format.  None if no
+    #              lease is available
+    def claimLease(self,workerId,leaseSeconds):
+        currentTime = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute(
+                "UPDATE leases SET status = 'failed', error = 'lease expired on every attempt' " +
+                "WHERE status = 'leased' AND expires < ? AND attempt >= ?",(currentTime,self.maxAttempts)
+            )
+            row = self.conn.execute(
+                "SELECT stage, leaseIndex, attempt, files, outputFormat FROM leases " +
+                "WHERE status = 'pending' OR (status = 'leased' AND expires < ?) " +
+                "ORDER BY stage, leaseIndex LIMIT 1",(currentTime,)
+            ).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    "UPDATE leases SET status = 'leased', workerId = ?, attempt = ?, expires = ? " +
+                    "WHERE stage = ? AND leaseIndex = ?",
+                    (workerId,row[2] + 1,currentTime + leaseSeconds,row[0],row[1])
+                )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return(None)
+        return((row[0],row[1],row[2] + 1,json.loads(row[3]),row[4]))
+
+    # extend a lease that is still held by an attempt
+    # INPUTS:
+    #    stage (str) - name of the processing stage
+    #    leaseIndex (int) - index of the lease within the stage
+    #    attempt (int) - attempt number returned by claimLease
+    #    leaseSeconds (float) - seconds from now until the lease expires
+    # OUTPUTS:
+    #    (boolean) - whether the attempt still holds the lease
+    def renewLease(self,stage,leaseIndex,attempt,leaseSeconds):
+        cursor = self.conn.execute(
+            "UPDATE leases SET expires = ? WHERE stage = ? AND leaseIndex = ? AND attempt = ? AND status = 'leased'",
+            (time.time() + leaseSeconds,stage,leaseIndex,attempt)
+        )
+        return(cursor.rowcount == 1)
+
+    # record the output file of a processed lease.  Only succeeds if the attempt still holds the lease
+    # INPUTS:
+    #    stage (str) - name of the processing stage
+    #    leaseIndex (int) - index of the lease within the stage
+    #    attempt (int) - attempt number returned by claimLease
+    #    outFilepath (str) - absolute filepath of the lease output file
+    #    numFailed (int) - number of images in the lease that could not be processed
+    # OUTPUTS:
+    #    (boolean) - whether the output was recorded.  If False, the lease was reassigned and the output
+    #                should be discarded
+    def completeLease(self,stage,leaseIndex,attempt,outFilepath,numFailed):
+        cursor = self.conn.execute(
+            "UPDATE leases SET status = 'done', outFilepath = ?, numFailed = ?, error = NULL " +
+            "WHERE stage = ? AND leaseIndex = ? AND attempt = ? AND status = 'leased'",
+            (outFilepath,numFailed,stage,leaseIndex,attempt)
+        )
+        return(cursor.rowcount == 1)
+
+    # give up a lease after an error, so it can be claimed again.  Leases that have been claimed maxAttempts
+    # times are marked as failed
+    # INPUTS:
+    #    stage (str) - name of the processing stage
+    #    leaseIndex (int) - index of the lease within the stage
+    #    attempt (int) - attempt number returned by claimLease
+    #    error (str) - description of the error
+    def releaseLease(self,stage,leaseIndex,attempt,error):
+        status = 'failed' if attempt >= self.maxAttempts else 'pending'
+        self.conn.execute(
+            "UPDATE leases SET status = ?, error = ? " +
+            "WHERE stage = ? AND leaseIndex = ? AND attempt = ? AND status = 'leased'",
+            (status,error,stage,leaseIndex,attempt)
+        )
+
+    # whether all leases of a stage (or of all stages) are done or failed
+    # INPUTS:
+    #    stage (str) - optional.  Name of the processing stage.  If None, all stages are checked
+    # OUTPUTS:
+    #    (boolean) - True if no leases are pending or leased
+    def isFinished(self,stage=None):
+        query = "SELECT COUNT(*) FROM leases WHERE status IN ('pending','leased')"
+        if stage is None:
+            return(self.conn.execute(query).fetchone()[0] == 0)
+        return(self.conn.execute(query + " AND stage = ?",(stage,)).fetchone()[0] == 0)
+
+    # summarize lease status for a stage
+    # INPUTS:
+    #    stage (str) - name of the processing stage
+    # OUTPUTS:
+    #    (dictionary) - key-value pairs of status and number of leases
+    def getStatusCounts(self,stage):
+        cursor = self.conn.execute("SELECT status, COUNT(*) FROM leases WHERE stage = ? GROUP BY status",(stage,))
+        return(dict(cursor.fetchall()))
+
+    # get the leases of a stage that are finished
+    # INPUTS:
+    #    stage (str) - name of the processing stage
+    # OUTPUTS:
+    #    (list) - lease index, status ('done' or 'failed'), files in the lease, output filepath, and error
+    #             tuples, in lease order
+    def getFinishedLeases(self,stage):
+        cursor = self.conn.execute(
+            "SELECT leaseIndex, status, files, outFilepath, error FROM leases " +
+            "WHERE stage = ? AND status IN ('done','failed') ORDER BY leaseIndex",(stage,)
+        )
+        return([(row[0],row[1],json.loads(row[2]),row[3],row[4]) for row in cursor])
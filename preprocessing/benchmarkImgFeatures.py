@@ -0,0 +1,292 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import numpy as np
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+import cv2
+from ImgFeatures import ImgFeatures, PSPNET_LABELS
+from ImgPrefetcher import ImgPrefetcher
+from StageProfiler import StageProfiler
+
+# benchmark ImgFeatures on synthetic PSPNet predictions and street view images.  Reports images/sec,
+# peak resident memory, load vs compute time, and time per processing step (see StageProfiler) for each
+# stage as json, so runs on different commits or machines can be compared.  Does not require the Place
+# Pulse data
+#
+# usage: python benchmarkImgFeatures.py --numImgs 200 --output bench.json [--baseline previous.json]
+
+# approximate share of pixels for the most common PSPNet labels in street view imagery.  Remaining
+# pixels are spread uniformly over all other labels
+LABEL_WEIGHTS = {
+    'sky':0.20,'building':0.18,'road':0.14,'tree':0.14,'sidewalk':0.06,'car':0.05,'wall':0.04,'grass':0.04,
+    'plant':0.03,'fence':0.02,'pole':0.02,'earth':0.01,'person':0.01,'signboard':0.01,'field':0.01,'flower':0.005
+}
+
+# hsv color of pixels for each label group in synthetic images.  Green labels fall within the green screen
+GREEN_LABELS = ['tree','grass','plant','field','flower']
+GREEN_HSV = (75,150,120)
+SKY_HSV = (110,80,220)
+OTHER_HSV = (15,40,110)
+
+# create a label probability vector over all PSPNet labels
+# INPUTS:
+#    allCategories (str list) - PSPNet labels, in integer order
+# OUTPUTS:
+#    (float array) - probability of each PSPNet integer value
+def createLabelProbs(allCategories):
+    otherWeight = (1.0 - sum(LABEL_WEIGHTS.values()))/(len(allCategories) - len(LABEL_WEIGHTS))
+    labelProbs = np.array([LABEL_WEIGHTS.get(category,otherWeight) for category in allCategories])
+    return(labelProbs/labelProbs.sum())
+
+# create a synthetic PSPNet prediction.  Labels are drawn for coarse blocks and upsampled, so the prediction
+# consists of contiguous regions like real segmentations, with a small fraction of isolated noise pixels
+# INPUTS:
+#    randomState (numpy RandomState) - random number generator
+#    labelProbs (float array) - probability of each PSPNet integer value
+#    height (int) - image height, in pixels
+#    width (int) - image width, in pixels
+#    blockSize (int) - size of contiguous label blocks, in pixels
+#    noiseFraction (float) - fraction of pixels with a random label
+# OUTPUTS:
+#    (2d uint8 array) - PSPNet class labels for all pixels
+def createSyntheticLabels(randomState,labelProbs,height,width,blockSize=16,noiseFraction=0.02):
+    numLabels = labelProbs.shape[0]
+    coarse = randomState.choice(numLabels,size=(-(-height//blockSize),-(-width//blockSize)),p=labelProbs)
+    labels = np.repeat(np.repeat(coarse,blockSize,axis=0),blockSize,axis=1)[:height,:width].astype(np.uint8)
+    noise = randomState.random_sample((height,width)) < noiseFraction
+    labels[noise] = randomState.choice(numLabels,size=int(noise.sum()),p=labelProbs)
+    return(labels)
+
+# create a synthetic image consistent with a PSPNet prediction.  Green labels are colored green, sky is
+# colored blue, and everything else is colored brown, with per-pixel noise.  Channels are ordered so the hsv
+# values are recovered by ImgFeatures.loadJpgImg, which converts images read by cv2 with COLOR_RGB2HSV
+# INPUTS:
+#    randomState (numpy RandomState) - random number generator
+#    labels (2d uint8 array) - PSPNet class labels for all pixels
+#    allCategories (str list) - PSPNet labels, in integer order
+# OUTPUTS:
+#    (3d uint8 array) - image to write with cv2.imwrite
+def createSyntheticImage(randomState,labels,allCategories):
+    colorLut = np.tile(np.array(OTHER_HSV,dtype=np.uint8),(256,1))
+    for label in GREEN_LABELS:
+        colorLut[allCategories.index(label)] = GREEN_HSV
+    colorLut[allCategories.index('sky')] = SKY_HSV
+    hsv = colorLut[labels].astype(np.int16) + randomState.randint(-10,11,size=labels.shape + (3,))
+    hsv = np.clip(hsv,0,255).astype(np.uint8)
+    return(cv2.cvtColor(hsv,cv2.COLOR_HSV2RGB))
+
+# write synthetic .jpg images and matching PSPNet .npy predictions
+# INPUTS:
+#    imgFolder (str) - absolute filepath to folder where .jpg images are written
+#    npyFolder (str) - absolute filepath to folder where .npy predictions are written
+#    numImgs (int) - number of image pairs to create
+#    height (int) - image height, in pixels
+#    width (int) - image width, in pixels
+#    seed (int) - random seed
+# OUTPUTS:
+#    (str list) - filename stems of the created image pairs
+def createSyntheticFixtures(imgFolder,npyFolder,numImgs,height=300,width=400,seed=0):
+    for folder in [imgFolder,npyFolder]:
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+    allCategories = list(PSPNET_LABELS)
+    labelProbs = createLabelProbs(allCategories)
+    randomState = np.random.RandomState(seed)
+    stems = []
+    for index in range(numImgs):
+        stem = "synthetic_%06i" %(index)
+        labels = createSyntheticLabels(randomState,labelProbs,height,width)
+        np.save(npyFolder + "/" + stem + ".npy",labels)
+        cv2.imwrite(imgFolder + "/" + stem + ".jpg",createSyntheticImage(randomState,labels,allCategories))
+        stems.append(stem)
+    return(stems)
+
+# peak resident memory of the benchmark process so far, in megabytes.  The resource module is only available on
+# unix, so on Windows the peak working set is read with psutil if it is installed
+# OUTPUTS:
+#    (float) - peak resident memory in megabytes, or None if it can't be measured
+def getPeakRSS():
+    if resource is None:
+        if psutil is None:
+            return(None)
+        memoryInfo = psutil.Process().memory_info()
+        if not hasattr(memoryInfo,'peak_wset'):
+            return(None)
+        return(memoryInfo.peak_wset/2**20)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+    if(sys.platform == 'darwin'):
+        return(peak/2**20)
+    return(peak/2**10)
+
+# time a benchmark stage
+# INPUTS:
+#    name (str) - stage name
+#    numImgs (int) - number of images processed by the stage
+#    stageFunction (function) - runs the stage.  May return a dictionary of additional timings (e.g. load stall time)
+#    repeats (int) - number of times to run the stage.  The fastest run is reported
+#    profiler (StageProfiler) - optional.  Profiler of the ImgFeatures object being benchmarked.  Reset before each
+#                               run, and the per-stage timings of the fastest run are reported as 'profile'
+# OUTPUTS:
+#    (dictionary) - stage name, fastest wall time, images/sec, peak rss after the stage, and additional timings
+def timeStage(name,numImgs,stageFunction,repeats=1,profiler=None):
+    bestTime = None
+    breakdown = {}
+    for repeat in range(repeats):
+        if profiler is not None:
+            profiler.reset()
+        startTime = time.perf_counter()
+        stageBreakdown = stageFunction()
+        elapsed = time.perf_counter() - startTime
+        if(bestTime is None or elapsed < bestTime):
+            bestTime = elapsed
+            breakdown = stageBreakdown if stageBreakdown is not None else {}
+            if profiler is not None:
+                breakdown['profile'] = profiler.getMetrics()['stages']
+    stageResult = {
+        'stage':name,
+        'numImgs':numImgs,
+        'seconds':bestTime,
+        'imgsPerSec':numImgs/bestTime if bestTime > 0 else None,
+        'peakRSSMB':getPeakRSS()
+    }
+    if 'loadSeconds' in breakdown:
+        breakdown['computeSeconds'] = bestTime - breakdown['loadSeconds']
+    stageResult.update(breakdown)
+    return(stageResult)
+
+# run all benchmark stages on a folder of synthetic fixtures.  ImgFeatures is profiled (see StageProfiler), so each
+# stage reports time spent in processing steps such as jpg decoding, label mapping, and pair counting
+# INPUTS:
+#    workFolder (str) - absolute filepath to folder containing img and npy fixture folders
+#    numImgs (int) - number of image pairs in the fixture folders
+#    numSingle (int) - number of images used for the single image stages
+#    repeats (int) - number of times each stage is run
+#    queueDepth (int) - image prefetch depth for the folder drivers.  0 to load serially
+#    numThreads (int) - number of image reader threads for the folder drivers
+#    batchSize (int) - number of images per batch in the spatial folder driver
+# OUTPUTS:
+#    (dictionary list) - results of each stage, see timeStage
+def runBenchmarks(workFolder,numImgs,numSingle=20,repeats=3,queueDepth=0,numThreads=1,batchSize=1):
+    imgFolder = workFolder + "/imgs"
+    npyFolder = workFolder + "/npy"
+    spatialFolder = workFolder + "/spatial"
+    stages = []
+    startTime = time.perf_counter()
+    profiler = StageProfiler()
+    features = ImgFeatures(imgFolder,npyFolder,profiler=profiler)
+    stages.append({'stage':'init','numImgs':numImgs,'seconds':time.perf_counter() - startTime,'peakRSSMB':getPeakRSS()})
+    npyFiles = sorted([file for file in os.listdir(npyFolder) if file[-4:] == '.npy'])
+    jpgFiles = sorted([file for file in os.listdir(imgFolder) if file[-4:] == '.jpg'])
+    singleNpy = npyFiles[:numSingle]
+
+    def singleSpatial():
+        for file in singleNpy:
+            features.processSingleImage(npyFolder + "/" + file,features.numDict)
+    stages.append(timeStage('processSingleImage',len(singleNpy),singleSpatial,repeats,profiler))
+
+    def singleGreen():
+        for file in singleNpy:
+            features.processSingleImageGreen(imgFolder + "/" + file[:-4] + ".jpg",npyFolder + "/" + file)
+    stages.append(timeStage('processSingleImageGreen',len(singleNpy),singleGreen,repeats,profiler))
+
+    spatialResults = []
+    def allSpatial():
+        prefetcher = ImgPrefetcher(queueDepth,numThreads)
+        spatialResults[:] = [features.processAllImagesSpatial(npyFolder,npyFiles,prefetcher=prefetcher,batchSize=batchSize)]
+        return({'loadSeconds':prefetcher.stallTime})
+    stages.append(timeStage('processAllImagesSpatial',len(npyFiles),allSpatial,repeats,profiler))
+
+    def allGreen():
+        prefetcher = ImgPrefetcher(queueDepth,numThreads)
+        features.processAllImagesGreen(imgFiles=jpgFiles,prefetcher=prefetcher)
+        return({'loadSeconds':prefetcher.stallTime})
+    stages.append(timeStage('processAllImagesGreen',len(jpgFiles),allGreen,repeats,profiler))
+
+    # split spatial results into several csv shards, as written by BatchRunner
+    if not os.path.exists(spatialFolder):
+        os.makedirs(spatialFolder)
+    numShards = 4
+    shardSize = -(-len(npyFiles)//numShards)
+    for shard in range(numShards):
+        spatialResults[0].iloc[shard*shardSize:(shard+1)*shardSize].to_csv(
+            spatialFolder + "/spatial_" + str(shard) + ".csv",index=False
+        )
+    def loadSpatial():
+        features.loadSpatialFiles(spatialFolder)
+    stages.append(timeStage('loadSpatialFiles',len(npyFiles),loadSpatial,repeats,profiler))
+    return(stages)
+
+# compare benchmark results to a previous run
+# INPUTS:
+#    stages (dictionary list) - results of the current run
+#    baseline (dictionary) - results of a previous run, as written by main
+# OUTPUTS:
+#    (dictionary) - key-value pairs of stage name and speedup relative to the baseline
+def compareToBaseline(stages,baseline):
+    baselineSeconds = dict([(stage['stage'],stage['seconds']) for stage in baseline['stages']])
+    speedups = {}
+    for stage in stages:
+        if(stage['stage'] in baselineSeconds and stage['seconds'] > 0):
+            speedups[stage['stage']] = baselineSeconds[stage['stage']]/stage['seconds']
+    return(speedups)
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark ImgFeatures on synthetic PSPNet predictions and images")
+    parser.add_argument('--numImgs',type=int,default=200,help="number of synthetic image pairs")
+    parser.add_argument('--height',type=int,default=300,help="image height, in pixels")
+    parser.add_argument('--width',type=int,default=400,help="image width, in pixels")
+    parser.add_argument('--numSingle',type=int,default=20,help="number of images for the single image stages")
+    parser.add_argument('--repeats',type=int,default=3,help="number of runs per stage.  The fastest run is reported")
+    parser.add_argument('--queueDepth',type=int,default=0,help="image prefetch depth for the folder drivers")
+    parser.add_argument('--numThreads',type=int,default=1,help="number of image reader threads")
+    parser.add_argument('--batchSize',type=int,default=1,help="batch size for the spatial folder driver")
+    parser.add_argument('--seed',type=int,default=0,help="random seed for the synthetic fixtures")
+    parser.add_argument('--workFolder',default=None,help="folder for fixtures.  Defaults to a temporary folder that is removed")
+    parser.add_argument('--output',default=None,help="filepath of the json results.  Defaults to stdout")
+    parser.add_argument('--baseline',default=None,help="json results of a previous run to compare against")
+    args = parser.parse_args()
+
+    workFolder = args.workFolder if args.workFolder is not None else tempfile.mkdtemp(prefix="imgFeaturesBench_")
+    try:
+        # progress messages from ImgFeatures go to stderr so stdout only contains json results
+        with contextlib.redirect_stdout(sys.stderr):
+            if not os.path.exists(workFolder + "/npy"):
+                createSyntheticFixtures(workFolder + "/imgs",workFolder + "/npy",args.numImgs,args.height,args.width,args.seed)
+            stages = runBenchmarks(workFolder,args.numImgs,args.numSingle,args.repeats,args.queueDepth,
+                                   args.numThreads,args.batchSize)
+    finally:
+        if args.workFolder is None:
+            shutil.rmtree(workFolder,ignore_errors=True)
+    results = {
+        'timestamp':time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'platform':platform.platform(),
+        'python':platform.python_version(),
+        'numpy':np.__version__,
+        'config':vars(args),
+        'stages':stages
+    }
+    if args.baseline is not None:
+        with open(args.baseline) as baselineFile:
+            results['speedupVsBaseline'] = compareToBaseline(stages,json.load(baselineFile))
+    if args.output is not None:
+        with open(args.output,'w') as outFile:
+            json.dump(results,outFile,indent=2)
+    else:
+        print(json.dumps(results,indent=2))
+
+if __name__ == '__main__':
+    main()